@@ -7,10 +7,19 @@ This allows us to generate all words in the game.
 
 import argparse
 import collections
-import json
+import functools
+import mmap
+import operator
 import re
 import sys
 
+# orjson parses the (large) game data several times faster, but isn't
+# required.
+try:
+    from orjson import loads as load_json
+except ImportError:
+    from json import loads as load_json
+
 # Out-of-game data: To use the ancientrunes font, we must map rune names to
 # characters. This essentially requires hardcoding the knowledge of what all
 # the runes are, alas.
@@ -62,6 +71,7 @@ FONTMAP = {
     'mineral': 'y',
     'heat': 'z',
 }
+FONTMAP_GLYPHS = frozenset(FONTMAP.values())
 
 # Constants to use instead of string lookup keys
 NAME = 'name'
@@ -71,89 +81,148 @@ PREFIX = 'prefix'
 MODIFIER = 'modifier'
 PUNCTUATION = 'punctuation'
 
-Atom = collections.namedtuple('Atom', [NAME, TYPE])
-Word = collections.namedtuple('Word',
-        [NAME, 'equivalences', 'components', 'atoms'])
+
+class Word:
+    """A word from the game data, along with its computed atom-string.
+
+    component_keys are the casefolded components, for looking them up. atoms
+    is filled in by compute_words().
+    """
+    __slots__ = (NAME, 'equivalences', 'components', 'component_keys', 'atoms')
+
+    def __init__(self, name, equivalences, components, component_keys, atoms):
+        self.name = name
+        self.equivalences = equivalences
+        self.components = components
+        self.component_keys = component_keys
+        self.atoms = atoms
+
+
+# Single-character codes for each atom type; the atom dictionary maps glyphs
+# to these. canonicalize() translates words into strings of these, so that it
+# can find the places that need punctuation with regexes instead of looping
+# over the glyphs in Python. The regexes depend on these exact letters.
+TYPE_CODES = {
+    ATOM: 'A',
+    PREFIX: 'P',
+    TYPE: 'T',
+    MODIFIER: 'M',
+    PUNCTUATION: 'X',
+}
+AtomTables = collections.namedtuple('AtomTables', ['squash', 'types', 'dedup'])
+# Matches just before a place where canonicalize() might add punctuation, in a
+# type string: After a type that isn't followed by another type, or before a
+# prefix that doesn't follow another prefix.
+_PUNCTUATION_SITES = re.compile(r'T(?=[^T])|[^P](?=P)')
+# Matches the "of" glyph, when something follows it.
+_AFTER_OF = re.compile(r"'(?=.)")
 
 def compute_atoms(atoms_list):
-    """Computes and returns the atom dictionary"""
-    atoms = {FONTMAP[x[NAME].casefold()] : Atom(x[NAME], x['atomType']) for x in atoms_list}
-    atoms[FONTMAP['joinglyph1']] = Atom('joinGlyph1', PUNCTUATION)
-    atoms[FONTMAP['joinglyph2']] = Atom('joinGlyph2', PUNCTUATION)
-    atoms[FONTMAP['primitive']] = Atom('primitive', PUNCTUATION)
-    for atom_name, atom in FONTMAP.items():
-        if atom not in atoms:
-            raise RuntimeError('%s not found in data' % atom_name)
+    """Computes and returns the atom dictionary, mapping glyphs to type codes"""
+    # Any unexpected type is treated like a modifier, which is to say it
+    # doesn't take part in any of the punctuation rules.
+    atoms = {FONTMAP[x[NAME].casefold()] :
+            TYPE_CODES.get(x['atomType'], TYPE_CODES[MODIFIER]) for x in atoms_list}
+    atoms[FONTMAP['joinglyph1']] = TYPE_CODES[PUNCTUATION]
+    atoms[FONTMAP['joinglyph2']] = TYPE_CODES[PUNCTUATION]
+    atoms[FONTMAP['primitive']] = TYPE_CODES[PUNCTUATION]
+    missing = FONTMAP_GLYPHS - atoms.keys()
+    if missing:
+        raise RuntimeError('%s not found in data' % ', '.join(
+            atom_name for atom_name, atom in FONTMAP.items() if atom in missing))
     return atoms
 
 
-def canonicalize(atom_string, atoms):
+def compute_atom_tables(atoms):
+    """Computes the lookup tables that canonicalize() needs"""
+    # All the glyphs are ASCII, so canonicalize() can work on bytes.
+    def glyphs(*codes):
+        return ''.join(x for x,y in atoms.items() if y in codes).encode('ascii')
+    squash_bytes = glyphs(TYPE_CODES[PUNCTUATION])
+    # A 256-entry table indexed by glyph byte, for bytes.translate().
+    type_table = bytes.maketrans(''.join(atoms).encode('ascii'),
+            ''.join(atoms.values()).encode('ascii'))
+    # A prefix or type glyph is dropped if it repeats the last prefix or type
+    # glyph, as long as no atom came in between; anything else (modifiers)
+    # doesn't interrupt the run. This matches a glyph followed by one or more
+    # such repeats.
+    dedup_chars = re.escape(glyphs(TYPE_CODES[PREFIX], TYPE_CODES[TYPE]))
+    run_breakers = re.escape(
+            glyphs(TYPE_CODES[PREFIX], TYPE_CODES[TYPE], TYPE_CODES[ATOM]))
+    dedup = re.compile(rb'([%s])((?:[^%s]*\1)+)' % (dedup_chars, run_breakers))
+    return AtomTables(squash_bytes, type_table, dedup)
+
+
+def canonicalize(atom_string, tables):
     """Puts punctuation into words in the proper places.
 
-    This algorithm is directly reverse-engineered from the C# code.
+    This algorithm is directly reverse-engineered from the C# code. Rather than
+    looping over the glyphs one at a time, it works on a parallel "type
+    string" (see TYPE_CODES), so that the scanning happens inside the regex
+    engine.
     """
     # Remove existing punctuation. Surprisingly, the algorithm does not build
     # words by putting punctuation between subwords, but instead flattens
     # everything and then adds punctuation fresh each time.
-    squash_dict = {ord(x):None for x,y in atoms.items() if y.type == PUNCTUATION}
-    atom_string = atom_string.translate(squash_dict)
-    orig_len = len(atom_string)
+    atom_bytes = atom_string.encode('ascii').translate(None, tables.squash)
+    orig_len = len(atom_bytes)
+    # None of the rules below can change a single glyph.
+    if orig_len <= 1:
+        return atom_bytes.decode('ascii')
     # Deduplicate certain atoms in very specific circumstances. This handles
     # changing verbs tenses, etc, but it also does some weirder
     # omissions that make less sense.
-    new_list = []
-    current = None
-    for atom in atom_string:
-        atom_type = atoms[atom].type
-        if atom_type in (PREFIX, TYPE):
-            if current != atom:
-                current = atom
-            else:
-                continue
-        elif atom_type == ATOM:
-            current = None
-        new_list.append(atom)
-    atom_string = ''.join(new_list)
+    atom_bytes = tables.dedup.sub(
+            lambda match: match[1] + match[2].replace(match[1], b''), atom_bytes)
+    atom_string = atom_bytes.decode('ascii')
+    types = atom_bytes.translate(tables.types).decode('ascii')
     # We need to maintaim the length specially, because of an edge-case: The
     # original algorithm inserts into the list as it iterates, increasing the
     # length, and since there's a length test we need to emulate that to get
     # proper behavior.
     curr_len = len(atom_string)
-    # The core loop that adds punctuation
-    prev_atom = atom_string[0]
-    new_list = [prev_atom]
-    prev_type = atoms[prev_atom].type
-    needs_join = prev_type == PREFIX
-    for atom in atom_string[1:]:
-        atom_type = atoms[atom].type
+    # Find every position where one of the rules below could add punctuation,
+    # and only visit those; everywhere else, the glyphs are copied through
+    # untouched.
+    sites = [match.end() for match in _PUNCTUATION_SITES.finditer(types)]
+    if curr_len <= 4 and "'" in atom_string:
+        sites = sorted(set(sites).union(
+                match.end() for match in _AFTER_OF.finditer(atom_string)))
+    new_list = []
+    start = 0
+    needs_join = types[0] == 'P'
+    for pos in sites:
+        prev_type = types[pos - 1]
+        atom_type = types[pos]
         # This rule is responsible for most of the dots in words.
         # Note that post-type transitions take precedence over pre-prefix
         # transitions, which is why you see dots in a lot of places you might
         # expect colons.
-        if prev_type == TYPE and atom_type != TYPE:
-            new_list.append('.')
-            curr_len += 1
+        if prev_type == 'T' and atom_type != 'T':
+            punct = '.'
         # The length part of this rule is why certain possessives don't have a
         # dot, effectively becoming indistinguishable from "of NOUN". Since
         # this is applied globally, some compounds get the dot dropped when
         # included in a larger word.
-        elif prev_atom == "'" and curr_len <= 4:
-            new_list.append('.')
-            curr_len += 1
+        elif atom_string[pos - 1] == "'" and curr_len <= 4:
+            punct = '.'
         # This adds in all the colons. I'm not sure what the justification is
         # for skipping the first one in certain narrow circumstances, but it's
         # why "parent" and several other "r.e"-starting words don't have an
         # colon joining them to the next subword.
-        elif atom_type == PREFIX and prev_type != PREFIX:
-            if needs_join or prev_type != ATOM:
-                new_list.append(':')
-                curr_len += 1
+        elif atom_type == 'P' and prev_type != 'P':
+            punct = ':' if needs_join or prev_type != 'A' else None
             needs_join = True
-        prev_atom = atom
-        new_list.append(prev_atom)
-        prev_type = atom_type
+        else:
+            continue
+        if punct:
+            new_list.append(atom_string[start:pos])
+            new_list.append(punct)
+            start = pos
+            curr_len += 1
+    new_list.append(atom_string[start:])
     atom_string = ''.join(new_list)
-    if orig_len == 2 and atoms[atom_string[0]].type == PREFIX:
+    if orig_len == 2 and types[0] == 'P':
         atom_string += ','
     # Remove all colons, but only if it leaves the final result at three
     # glyphs or less.
@@ -163,40 +232,56 @@ def canonicalize(atom_string, atoms):
     return atom_string
 
 
-def create_word(word, words, atoms):
-    """Computes the atom-string for word, if needed"""
-    if word.atoms is not None:
-        return word.atoms
-    atom_list = []
-    for part in word.components:
-        part = part.casefold()
-        atom = FONTMAP.get(part)
-        if atom:
-            atom_list.append(atom)
-        else:
-            subword = words[part]
-            sub_atoms = create_word(subword, words, atoms)
-            atom_list.append(sub_atoms)
-    atom_string = canonicalize(''.join(atom_list), atoms)
-    words[word.name.casefold()] = word._replace(atoms=atom_string)
-    return atom_string
-
-
 def compute_words(words_list, atoms):
     """Computes and returns the word dictionary"""
-    words = {x[NAME].casefold() : Word(
-        x[NAME], x.get('equivalences', []), x['components'], None) for x in words_list}
-    for word in words.values():
-        create_word(word, words, atoms)
+    # All the keys are interned, since they are looked up over and over.
+    words = {sys.intern(x[NAME].casefold()) : Word(
+        x[NAME], x.get('equivalences', []), x['components'],
+        [sys.intern(part.casefold()) for part in x['components']], None)
+        for x in words_list}
+    # Order the words so that every word comes after all of its subwords
+    # (Kahn's algorithm), so that they can be computed in a single pass.
+    users = collections.defaultdict(list)
+    waiting = {}
+    for key, word in words.items():
+        subwords = [part for part in word.component_keys if part not in FONTMAP]
+        for part in subwords:
+            if part not in words:
+                raise RuntimeError('%s not found in data' % part)
+            users[part].append(key)
+        waiting[key] = len(subwords)
+    order = [key for key, count in waiting.items() if not count]
+    # This appends to order while iterating over it.
+    for key in order:
+        for user in users[key]:
+            waiting[user] -= 1
+            if not waiting[user]:
+                order.append(user)
+    if len(order) != len(words):
+        raise RuntimeError('Circular definitions: %s' % ', '.join(
+            key for key, count in waiting.items() if count))
+    # Distinct words can flatten to the same atoms, so it's worth
+    # remembering the results for the duration of the computation.
+    canonicalize_func = functools.lru_cache(maxsize=None)(functools.partial(
+        canonicalize, tables=compute_atom_tables(atoms)))
+    fontmap_get = FONTMAP.get
+    for key in order:
+        word = words[key]
+        # Subwords are always computed by the time we get here.
+        atom_string = ''.join([fontmap_get(part) or words[part].atoms
+            for part in word.component_keys])
+        word.atoms = sys.intern(canonicalize_func(atom_string))
+    canonicalize_func.cache_clear()
     return words
 
 
 def compute_seen_words(inscription_list, coredata):
     """Computes the set of all words seen in phrases in the game"""
-    seen_words = {word
+    # Splitting all the phrases at once gives the same words as splitting
+    # each one. Trailing punctuation isn't part of the word.
+    seen_words = {word.rstrip('!?.,:') for word in ' '.join(phrase
         for inscription in inscription_list
-            for phrase in inscription['phrases']
-                for word in phrase.split()}
+            for phrase in inscription['phrases']).split()}
     # You can't parse JSON with regexes... but given that we know that none of
     # the strings we want have escaped double-quotes, or actually any escape
     # sequences at all, we *can* use regexes to find all the strings.
@@ -207,18 +292,22 @@ def compute_seen_words(inscription_list, coredata):
     # double-quotes or backslashes, which could de-sync our idea of when the
     # string ends. There are extra exceptions for the beginning of the string,
     # encoded as a zero-width negative lookahead assertion.
-    str_pat = re.compile(r'"\^(?![ ,.!-])[^"\\?:[>;_]+"')
-    for match in str_pat.finditer(coredata.read()):
-        print(match[0])
+    #
+    # The pattern starts with a literal '"^', which the regex engine already
+    # skips ahead to with a fast search, so finditer() is the quickest way to
+    # scan the file. It runs directly on the memory-mapped bytes, so the file
+    # is never read or decoded as a whole. The matches are written out in one
+    # go.
+    str_pat = re.compile(rb'"\^(?![ ,.!-])[^"\\?:[>;_]+"')
+    with mmap.mmap(coredata.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        sys.stdout.write(''.join(match[0].decode('utf-8') + '\n'
+            for match in str_pat.finditer(data)))
     return seen_words
 
 
-def lookup(word, word_dict):
-    """Find the relevant atom_string for a word"""
-    char = FONTMAP.get(word)
-    if char:
-        return char
-    return word_dict[word].atoms
+# The ALB template line that starts each row of the original table.
+ALB_LINE_START = '| {{ALB|'
+ALB_LINE_END = '}}'
 
 
 def parse_original(original_file):
@@ -226,49 +315,62 @@ def parse_original(original_file):
     words = {}
     key = None
     pending = []
-    # <nowiki> tags are optional. Meant to extract the text inside the
-    # template.
-    pat = re.compile(r'\| \{\{ALB\|(?:<nowiki>)?([^<>]*)(?:</nowiki>)?\}\}')
-    pat2 = re.compile(r'\| ?(.*)')
     for line in original_file:
         line = line.rstrip()
         if line == '|-':
             if key is not None:
                 if key in words:
-                    pending = words[key] + ["*duplicate*"] + pending
-                words[key] = pending
+                    words[key].extend(["*duplicate*", *pending])
+                else:
+                    words[key] = pending
                 key = None
                 pending = []
             continue
         if key is None:
-            match = pat.fullmatch(line)
-            if not match:
+            # <nowiki> tags are optional. Meant to extract the text inside
+            # the template.
+            if not (line.startswith(ALB_LINE_START)
+                    and line.endswith(ALB_LINE_END)):
+                raise ValueError("Couldn't match " + line)
+            atoms = line[len(ALB_LINE_START):-len(ALB_LINE_END)]
+            if atoms.startswith('<nowiki>'):
+                atoms = atoms[len('<nowiki>'):]
+            if atoms.endswith('</nowiki>'):
+                atoms = atoms[:-len('</nowiki>')]
+            if '<' in atoms or '>' in atoms:
                 raise ValueError("Couldn't match " + line)
-            key = match[1]
+            key = sys.intern(atoms)
         else:
-            match = pat2.fullmatch(line)
-            if not match:
+            if not line.startswith('|'):
                 raise ValueError("Couldn't match " + line)
-            pending.append(match[1])
+            pending.append(line[2:] if line.startswith('| ') else line[1:])
     if key is not None:
         if key in words:
-            pending = words[key] + ["*duplicate*"] + pending
-        words[key] = pending
+            words[key].extend(["*duplicate*", *pending])
+        else:
+            words[key] = pending
     return words
 
 
 ALB_TABLE = {ord(x): f'&#{ord(x)};' for x in "';:="}
+# Most words contain none of these, and checking is far cheaper than a
+# translate() that changes nothing.
+ALB_ESCAPED = frozenset("';:=")
+# The fixed part of every wikitable row; the Logic field is optional.
+WORD_ROW = '|-\n| {atoms}\n| {names}\n| {components}\n'
 
 
 def alb(atoms, use_nowiki):
     """Format atoms using Template:ALB"""
     if use_nowiki:
-        return '{{ALB|<nowiki>' + atoms + '</nowiki>}}'
-    return '{{ALB|' + atoms.translate(ALB_TABLE) + '}}'
+        return f'{{{{ALB|<nowiki>{atoms}</nowiki>}}}}'
+    if ALB_ESCAPED.isdisjoint(atoms):
+        return f'{{{{ALB|{atoms}}}}}'
+    return f'{{{{ALB|{atoms.translate(ALB_TABLE)}}}}}'
 
 
-def print_wiki_word(word, word_dict, seen_words, fields, use_nowiki):
-    """Print a wikitable entry for a single word"""
+def print_wiki_word(word, atoms_by_name, seen_words, fields, use_nowiki, out):
+    """Print a wikitable entry for a single word, by appending it to out"""
     orig_names = {}
     if fields:
         if fields[0].endswith('(s)'):
@@ -290,77 +392,92 @@ def print_wiki_word(word, word_dict, seen_words, fields, use_nowiki):
             names.append("''" + name + "''")
     for name in orig_names:
         names.append('!!' + name + '!!')
-    print('|-')
-    print('| ' + alb(word.atoms, use_nowiki))
-    print('| ' + ' / '.join(names))
-    print('| ' + ' '.join(
-        alb(lookup(x.casefold(), word_dict), use_nowiki) + f' ({x})'
-        for x in word.components))
+    row = WORD_ROW.format(
+        atoms=alb(word.atoms, use_nowiki),
+        names=' / '.join(names),
+        components=' '.join(
+            alb(atoms_by_name[key], use_nowiki) + f' ({x})'
+            for x, key in zip(word.components, word.component_keys)))
     if fields and len(fields) >= 2 and fields[1]:
-        print('| ' + fields[1])
+        row += '| ' + fields[1] + '\n'
+    out.append(row)
 
 
 def generate_wikitable(word_dict, seen_words, original,
         use_nowiki=True, split_tables=False):
     """Print wikitable for the full word list"""
-    words = list(word_dict.values())
-    words.sort(key=lambda x:x.name.casefold())
+    # The keys are the casefolded names, and are unique, so this sorts by
+    # name without calling a key function.
+    words = [word for _, word in sorted(word_dict.items())]
     known_atoms = {x.atoms for x in word_dict.values()}
+    # The atom-string for every possible component, in one place.
+    atoms_by_name = {key: x.atoms for key, x in word_dict.items()}
+    atoms_by_name.update(FONTMAP)
 
     extra_words = []
     if split_tables:
         real_words = []
         for word in words:
-            (real_words if any(x in seen_words for x in [word.name] + word.equivalences)
-                else extra_words).append(word)
+            (extra_words if seen_words.isdisjoint((word.name, *word.equivalences))
+                else real_words).append(word)
     else:
         real_words = words
 
-    original_list = list(original.items())
-    original_list.sort(key=lambda x:x[1][0].casefold())
-    for atoms, fields in original_list:
+    # All the output is collected here and written in one go at the end.
+    out = []
+    write = out.append
+    # Names can repeat here, so this sorts on just the name to stay stable.
+    original_list = [(fields[0].casefold(), atoms, fields)
+            for atoms, fields in original.items()]
+    original_list.sort(key=operator.itemgetter(0))
+    for _, atoms, fields in original_list:
         # Output all the original bits that don't appear in the extracted data
         # first. They're either wrong, or the extracted data is wrong. Either
         # way, we want to see it up front.
         if atoms in known_atoms:
             continue
-        print('|-')
-        print('| ' + alb(atoms, use_nowiki))
+        lines = ['|-', '| ' + alb(atoms, use_nowiki)]
         # Only print the first 3 fields, we're trimming the last one.
         # We're also swapping the order of the last two fields.
-        print('| ' + fields[0])
+        lines.append('| ' + fields[0])
         if len(fields) >= 2:
             if len(fields) >= 3:
-                print('| ' + fields[2])
+                lines.append('| ' + fields[2])
             else:
-                print('|')
-            print('| ' + fields[1])
+                lines.append('|')
+            lines.append('| ' + fields[1])
+        lines.append('')  # For the trailing newline
+        write('\n'.join(lines))
 
-    print("""{|class="wikitable sortable" style="text-align:center"
+    write("""{|class="wikitable sortable" style="text-align:center"
 ! '''Word'''
 ! '''Meaning'''
 ! '''Subwords'''
-! '''Logic'''""")
+! '''Logic'''
+""")
     for word in (real_words if split_tables else words):
-        print_wiki_word(word, word_dict, seen_words, original.get(word.atoms), use_nowiki)
+        print_wiki_word(word, atoms_by_name, seen_words, original.get(word.atoms),
+                use_nowiki, out)
     if split_tables:
-        print("""|}
+        write("""|}
 
 == Extra Words ==
 
 {|class="wikitable sortable" style="text-align:center"
 ! '''Word'''
 ! '''Meaning'''
-! '''Subwords'''""")
+! '''Subwords'''
+""")
     for word in extra_words:
-        print_wiki_word(word, word_dict, seen_words, None, use_nowiki)
-    print('|}')
+        print_wiki_word(word, atoms_by_name, seen_words, None, use_nowiki, out)
+    write('|}\n')
+    sys.stdout.write(''.join(out))
 
 
 def main():
     """main(). Thanks, pylint."""
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('game_data', type=argparse.FileType('r'),
+    parser.add_argument('game_data', type=argparse.FileType('rb'),
         help="The GameData.json file")
     parser.add_argument('-w', '--wikitable', action='store_true',
         help="Output words as the body of a wiki table")
@@ -368,13 +485,13 @@ def main():
         help="Original wiki table content to merge")
     parser.add_argument('-q', '--quote', action='store_true',
         help="Use &apos; instead of <nowiki> to escape Ancient words")
-    parser.add_argument('-c', '--coredata', type=argparse.FileType('r'),
+    parser.add_argument('-c', '--coredata', type=argparse.FileType('rb'),
         help="Path to core.json file. Needed to highlight seen words.")
     parser.add_argument('-s', '--split', action='store_true',
         help="Split tables into a seen and unseen (extra) component")
 
     args = parser.parse_args()
-    data = json.load(args.game_data)
+    data = load_json(args.game_data.read())
     atoms = compute_atoms(data['atoms'])
     words = compute_words(data['words'], atoms)
     expanded_words = {x
@@ -383,14 +500,11 @@ def main():
     expanded_words |= {'a', 'an', 'the', 'to'}
     if args.coredata:
         seen_words = compute_seen_words(data['inscriptionDatabase'], args.coredata)
+        for word in seen_words - expanded_words:
+            print('Unknown word used in phrase: ' + word, file=sys.stderr)
     else:
         # Mark everything as seen
         seen_words = expanded_words
-    for word in seen_words:
-        if len(word) and word[-1] in "!?.,:":
-            word = word[:-1]
-        if word not in expanded_words:
-            print('Unknown word used in phrase: ' + word, file=sys.stderr)
     original_content = {}
     if args.merge:
         original_content = parse_original(args.merge)